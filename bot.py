@@ -1,14 +1,15 @@
-from json import dumps
+from asyncio import gather
+from functools import lru_cache
 from traceback import format_exception
 from html import escape as html_escape
 
 from telegram.constants import ParseMode
 from telegram import BotCommand, Update
-from telegram.ext import filters, Application, CommandHandler, MessageHandler, ContextTypes, CallbackContext
+from telegram.ext import filters, AIORateLimiter, Application, CommandHandler, MessageHandler, ContextTypes, CallbackContext
 
-from storage import cursor, data_cache, get_user_data
+from storage import data_cache, execute, get_user_data
 from settings import get_settings, Language, DatabaseTables
-from utils import chunkify_html_text, get_logger, remove_update_sensitive_info
+from utils import chunkify_html_text, get_logger, json_dumps, remove_update_sensitive_info, run_in_background
 from keyboards import AnimeKeyboardHandler, CharacterKeyboardHandler, HelpKeyboardHandler, MangaKeyboardHandler
 
 
@@ -16,28 +17,85 @@ debug_handlers = set()
 settings = get_settings()
 logger = get_logger(__name__)
 
+bot_commands = (
+    BotCommand("start", "Start the bot"),
+    BotCommand("help", "Get help about this bot"), 
+    BotCommand("about", "Get information about the bot"),
+
+    BotCommand("anime", "Get information about an anime"),
+    BotCommand("manga", "Get information about a manga"),
+    BotCommand("character", "Get information about a character"),
+)
+
+welcome_templates = {
+    Language.ENGLISH: "Welcome {0} {1}!\nI am {2}\nUse the help command (/help) to view the guide",
+    Language.ROMAJI: "Hajimemashite {0} {1}!\n Watashi wa {2} desu.\nUse the help command (/help) to view the guide",
+    Language.JAPANESE: "はじめまして {0} {1}!\nわたしはアリエスです (I am ARIES).\nUse the help command (/help) to open the guide.",
+}
+
+
+
+@lru_cache(maxsize = 32)
+def serialize_update(update: Update) -> str:
+    # Cached so an update that is logged as a command and then fails is only serialized once
+    update_str = json_dumps(update.to_dict(), indent = True)
+    return remove_update_sensitive_info(update_str)
+
+
+def get_update_log_text(update: object) -> str:
+    if isinstance(update, Update):
+        return serialize_update(update)
+    return remove_update_sensitive_info( json_dumps(str(update), indent = True) )
 
 
 def log_command_usage(func):
     async def log_command(self, update: Update, context: BotContext):
-        update_str = dumps(update.to_dict() if isinstance(update, Update) else str(update), indent = 2, ensure_ascii = False)
-        update_str = remove_update_sensitive_info(update_str)
-        text = f"<pre>update = {html_escape(update_str)}</pre>\n"
-        await log_in_channels(text, context)
+        # Skip building the log text when there is nowhere to send it
+        if settings.LOG_CHAT_IDS:
+            update_str = get_update_log_text(update)
+            text = f"<pre>update = {html_escape(update_str)}</pre>\n"
+            run_in_background( log_in_channels(text, context) )
         return await func(self, update, context)
     return log_command
 
 
+def log_send_exceptions(results: list) -> None:
+    # Sends are gathered with return_exceptions, so failures have to be picked out of the results
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error("Failed to send message to chat:", exc_info = result)
+
+
+async def send_to_chats(chunks: list[str], chat_ids: frozenset[int], context: CallbackContext):
+    if not chat_ids:
+        return
+
+    # Chunks are sent in order within a chat, the chats themselves are sent to concurrently
+    async def send_chunks(chat_id: int):
+        for chunk in chunks:
+            await context.bot.send_message(chat_id = chat_id, text = chunk, parse_mode = ParseMode.HTML)
+
+    results = await gather( *( send_chunks(chat_id) for chat_id in chat_ids ), return_exceptions = True )
+    log_send_exceptions(results)
+
+
 async def log_in_channels(text: str, context: CallbackContext):
-    for chat_id in settings.LOG_CHAT_IDS:
-        await context.bot.send_message(chat_id = chat_id, text = text, parse_mode = ParseMode.HTML)
+    await send_to_chats([text], settings.LOG_CHAT_IDS, context)
     
  
 async def send_to_developers(text: str, context: CallbackContext):
-    for chat_id in settings.DEVELOPER_CHAT_IDS:
-        chunks = chunkify_html_text(text)
-        for chunk in chunks:
-            await context.bot.send_message(chat_id = chat_id, text = chunk, parse_mode = ParseMode.HTML)
+    if not settings.DEVELOPER_CHAT_IDS:
+        return
+    await send_to_chats(chunkify_html_text(text, fast = True), settings.DEVELOPER_CHAT_IDS, context)
+
+
+
+def debug_handler(func):
+    async def wrapper(self, update: Update, context: BotContext):
+        if update.effective_user.id not in settings.DEVELOPER_CHAT_IDS:
+            return
+        return await func(self, update, context)
+    return wrapper 
 
 
 
@@ -50,13 +108,15 @@ class BotContext(CallbackContext):
 
 
 
-class Bot:
+class BaseBot:
     def __init__(self, bot_token: str) -> None:
         """Set up bot application and a web application for handling the incoming requests."""
         
         # Set updater to None so updates are handled by webhook
         context_types = ContextTypes(context = BotContext)
-        self.application = Application.builder().token(bot_token).updater(None).context_types(context_types).build()
+        # Queue outgoing requests to stay within Telegram's flood limits instead of getting 429 errors
+        rate_limiter = AIORateLimiter(overall_max_rate = 30, overall_time_period = 1, group_max_rate = 20, group_time_period = 60)
+        self.application = Application.builder().token(bot_token).updater(None).context_types(context_types).rate_limiter(rate_limiter).build()
 
 
     async def setup(self, secret_token: str, bot_web_url: str) -> None:
@@ -67,43 +127,41 @@ class Bot:
         # Add handlers here
         self.application.add_error_handler(self.handle_error)
 
-        self.application.add_handler( CommandHandler("start", self.cmd_start) )
-        self.application.add_handler( CommandHandler("help", self.cmd_help) )
-        self.application.add_handler( CommandHandler("id", self.cmd_id) )
-        self.application.add_handler( CommandHandler("about", self.cmd_about) )
+        self.application.add_handlers([
+            CommandHandler("start", self.cmd_start),
+            CommandHandler("help", self.cmd_help),
+            CommandHandler("id", self.cmd_id),
+            CommandHandler("about", self.cmd_about),
 
-        self.application.add_handler( CommandHandler("anime", self.cmd_anime) )
-        self.application.add_handler( CommandHandler("character", self.cmd_character) )
-        self.application.add_handler( CommandHandler("manga", self.cmd_manga) )
+            CommandHandler("anime", self.cmd_anime),
+            CommandHandler("character", self.cmd_character),
+            CommandHandler("manga", self.cmd_manga),
+        ])
 
         if settings.DEBUG:
             self.add_debug_handlers()
 
             
-        self.application.add_handler( AnimeKeyboardHandler().create_handler() )
-        self.application.add_handler( CharacterKeyboardHandler().create_handler() )
-        self.application.add_handler( MangaKeyboardHandler().create_handler() )
-        self.application.add_handler( HelpKeyboardHandler().create_handler() )
+        self.application.add_handlers([
+            AnimeKeyboardHandler().create_handler(),
+            CharacterKeyboardHandler().create_handler(),
+            MangaKeyboardHandler().create_handler(),
+            HelpKeyboardHandler().create_handler(),
 
-        self.application.add_handler( MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, self.handle_new_member) )
-        self.application.add_handler( MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER, self.handle_left_member) )
-        self.application.add_handler( MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message) )
+            MessageHandler(filters.StatusUpdate.NEW_CHAT_MEMBERS, self.handle_new_member),
+            MessageHandler(filters.StatusUpdate.LEFT_CHAT_MEMBER, self.handle_left_member),
+            MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message),
+        ])
 
 
     # Bot methods
 
     async def set_bot_commands_menu(self) -> None:
-        # Register commands for bot menu
-        commands = [
-            BotCommand("start", "Start the bot"),
-            BotCommand("help", "Get help about this bot"), 
-            BotCommand("about", "Get information about the bot"),
-
-            BotCommand("anime", "Get information about an anime"),
-            BotCommand("manga", "Get information about a manga"),
-            BotCommand("character", "Get information about a character"),
-        ]
-        await self.application.bot.set_my_commands(commands)
+        # Register commands for bot menu, unless they are already registered
+        current_commands = await self.application.bot.get_my_commands()
+        if tuple(current_commands) == bot_commands:
+            return
+        await self.application.bot.set_my_commands(bot_commands)
 
 
     # Bot handlers
@@ -112,6 +170,8 @@ class Bot:
         """Log the error and send a message to notify the developer."""
         # Log the error first so it can be seen even if something breaks.
         logger.error("Exception while handling an update:", exc_info = context.error)
+        if not settings.LOG_CHAT_IDS:
+            return
 
         # traceback.format_exception returns the usual python message about an exception, but as a
         # list of strings rather than a single string, so we have to join them together.
@@ -120,22 +180,26 @@ class Bot:
 
         # Build the message with some markup and additional information about what happened.
 
-        update_str = dumps(update.to_dict() if isinstance(update, Update) else str(update), indent = 2, ensure_ascii = False)
-        update_str = remove_update_sensitive_info(update_str)
-        for text in (
+        update_str = get_update_log_text(update)
+        texts = (
             f"An exception was raised while handling an update\n"
             f"<pre>update = {html_escape(update_str)}</pre>\n",
 
             "<b>Context</b>\n"
-            f"<pre><u>context.bot_data</u> = {html_escape(dumps(context.bot_data, indent = 2, ensure_ascii = False))}</pre>\n\n"
-            f"<pre><u>context.chat_data</u> = {html_escape(dumps(context.chat_data, indent = 2, ensure_ascii = False))}</pre>\n\n"
-            f"<pre><u>context.user_data</u> = {html_escape(dumps(context.user_data, indent = 2, ensure_ascii = False))}</pre>\n\n",
+            f"<pre><u>context.bot_data</u> = {html_escape(json_dumps(context.bot_data, indent = True))}</pre>\n\n"
+            f"<pre><u>context.chat_data</u> = {html_escape(json_dumps(context.chat_data, indent = True))}</pre>\n\n"
+            f"<pre><u>context.user_data</u> = {html_escape(json_dumps(context.user_data, indent = True))}</pre>\n\n",
             
             "<b>Traceback</b>\n"
             f"<pre>{html_escape(tb_string)}</pre>\n",
-        ):
-            for chunk in chunkify_html_text(text):
-                await log_in_channels(chunk, context)
+        )
+
+        # Nothing depends on the log being delivered, so don't hold up the update while it is sent
+        async def send_all():
+            chunks = [ chunk for text in texts for chunk in chunkify_html_text(text, fast = True) ]
+            await send_to_chats(chunks, settings.LOG_CHAT_IDS, context)
+
+        run_in_background( send_all() )
 
 
     async def handle_message(self, update: Update, context: BotContext) -> None:
@@ -149,13 +213,13 @@ class Bot:
     async def handle_new_member(self, update: Update, context: BotContext):
         chat = update.effective_chat
         for member in update.effective_message.new_chat_members:
-            if member == context.bot.get_me():
+            if member.id == context.bot.id:
                 await log_in_channels( f"Was added to {chat.type} chat: {chat.title} with id: {chat.id}", context )
 
 
     async def handle_left_member(self, update: Update, context: BotContext):
         chat = update.effective_chat
-        if update.effective_message.left_chat_member == context.bot.get_me():
+        if update.effective_message.left_chat_member.id == context.bot.id:
             await log_in_channels( f"Left {chat.type} chat: {chat.title} with id: {chat.id}", context )
 
 
@@ -163,7 +227,7 @@ class Bot:
     # Bot commands
 
     async def cmd_restart(self, update: Update, context: BotContext) -> None:
-        if update.effective_user.id is settings.DEVELOPER_CHAT_IDS:
+        if update.effective_user.id in settings.DEVELOPER_CHAT_IDS:
             context.bot_data["restart"] = True
 
 
@@ -175,17 +239,11 @@ class Bot:
         user_data = await get_user_data(user.id, DatabaseTables.PREFERENCES)
         language = user_data['language']
 
-        match language:
-            case Language.ENGLISH: 
-                text = "Welcome {0} {1}!\nI am {2}\nUse the help command (/help) to view the guide"
-            case Language.ROMAJI:
-                text = "Hajimemashite {0} {1}!\n Watashi wa {2} desu.\nUse the help command (/help) to view the guide"
-            case Language.JAPANESE:
-                text = "はじめまして {0} {1}!\nわたしはアリエスです (I am ARIES).\nUse the help command (/help) to open the guide."
-            case _:
-                raise Exception(f"'{language}' is not a valid language")
+        template = welcome_templates.get(language)
+        if template is None:
+            raise Exception(f"'{language}' is not a valid language")
         
-        text = text.format(user.username, user.name, context.bot.username)
+        text = template.format(user.username, user.name, context.bot.username)
         await update.effective_message.reply_text(text)
 
 
@@ -240,33 +298,38 @@ class Bot:
         await MangaKeyboardHandler.handle_first(update, context)
 
 
-    if settings.DEBUG:
-        def debug_handler(func):
-            async def wrapper(self, update: Update, context: BotContext):
-                if update.effective_user.id not in settings.DEVELOPER_CHAT_IDS:
-                    return
-                return await func(self, update, context)
-            return wrapper 
 
-        @debug_handler
-        async def raise_bot_exception(self, update: Update, context: BotContext):
-            context.bot.this_method_does_not_exist_not_a_bug_007()
+class DebugBotMixin:
+    """Commands for debugging the bot, only available to developers when debugging is enabled"""
 
-        @debug_handler
-        async def print_data_cache(self, update: Update, context: BotContext):
-            text = f"<pre>data_cache = {html_escape(dumps(data_cache, indent = 2, ensure_ascii = False))}</pre>"
-            await update.effective_message.reply_html(text)
+    @debug_handler
+    async def raise_bot_exception(self, update: Update, context: BotContext):
+        context.bot.this_method_does_not_exist_not_a_bug_007()
+
+    @debug_handler
+    async def print_data_cache(self, update: Update, context: BotContext):
+        text = f"<pre>data_cache = {html_escape(json_dumps(data_cache, indent = True))}</pre>"
+        await update.effective_message.reply_html(text)
+
+    @debug_handler
+    async def execute_sql(self, update: Update, context: BotContext):
+        result = await execute(" ".join(context.args))
+        text = json_dumps(result)
+        await update.effective_message.reply_text(text)
 
-        @debug_handler
-        async def execute_sql(self, update: Update, context: BotContext):
-            command = cursor.execute(""" """.join(context.args))
-            result = command.fetchall()
-            text = dumps(result)
-            await update.effective_message.reply_text(text)
+    def add_debug_handlers(self):
+        self.application.add_handlers([
+            CommandHandler("raise", self.raise_bot_exception),
+            CommandHandler("cache", self.print_data_cache),
+            CommandHandler("sql", self.execute_sql),
+        ])
 
-        def add_debug_handlers(self):
-            self.application.add_handler(CommandHandler("raise", self.raise_bot_exception))
-            self.application.add_handler(CommandHandler("cache", self.print_data_cache))
-            self.application.add_handler(CommandHandler("sql", self.execute_sql))
 
 
+# The debug commands are only part of the bot when debugging is enabled
+if settings.DEBUG:
+    class Bot(DebugBotMixin, BaseBot):
+        pass
+else:
+    class Bot(BaseBot):
+        pass
@@ -1,36 +1,77 @@
+import re
+from asyncio import gather
 from enum import StrEnum
-from json import loads, dumps
+import orjson
 from anilist import AsyncClient
 
+from telegram.constants import ParseMode
 from telegram import error, Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import CallbackContext, CallbackQueryHandler, CommandHandler, BaseHandler
 
 from settings import DatabaseTables, Language
 from storage import get_user_data, set_user_data
-from utils import clamp, remove_unspecified_tags, format_anime, format_character, format_manga
+from utils import async_ttl_cache, clamp, json_dumps, remove_unspecified_tags, format_anime, format_character, format_manga
 
 
 
 __all__ = (
+    "anilist_client",
     "AnimeKeyboardHandler",
     "CharacterKeyboardHandler",
     "HelpKeyboardHandler",
     "MangaKeyboardHandler",
 )
 
+# Shared by all pagination keyboards, main.lifespan keeps it open so requests reuse one connection pool
+anilist_client = AsyncClient()
+
+
 class OnePage:
     last = 1
     current = 1
     per_page = 1
 
 
+# AniList data rarely changes, so lookups are cached to save a request on every page change
+@async_ttl_cache(maxsize = 1024, ttl = 3600)
+async def get_anime(client: AsyncClient, anime_id: int):
+    return await client.get_anime(anime_id)
+
+@async_ttl_cache(maxsize = 1024, ttl = 3600)
+async def get_character(client: AsyncClient, character_id: int):
+    return await client.get_character(character_id)
+
+@async_ttl_cache(maxsize = 1024, ttl = 3600)
+async def get_manga(client: AsyncClient, manga_id: int):
+    return await client.get_manga(manga_id)
+
+@async_ttl_cache(maxsize = 256, ttl = 300)
+async def search_anime(client: AsyncClient, query: str, per_page: int, page: int):
+    return await client.search_anime(query, per_page, page)
+
+@async_ttl_cache(maxsize = 256, ttl = 300)
+async def search_character(client: AsyncClient, query: str, per_page: int, page: int):
+    return await client.search_character(query, per_page, page)
+
+@async_ttl_cache(maxsize = 256, ttl = 300)
+async def search_manga(client: AsyncClient, query: str, per_page: int, page: int):
+    return await client.search_manga(query, per_page, page)
+
+
+async def get_all(get, client: AsyncClient, results: list) -> list:
+    # Concurrent calls are only safe on an open client, otherwise the first to finish closes the httpx client the others use
+    if client.httpx is None:
+        return [ await get(client, result.id) for result in results ]
+    return await gather( *( get(client, result.id) for result in results ) )
+
+
 class KeyboardHandler:
     """An interface intended for managing Telegram inline keyboards and their callbacks
 
     Raises:
         NotImplementedError: If methods are not overriden.
     """
-    pattern: str = None
+    pattern: re.Pattern = None
 
     @classmethod
     def create_handler(cls) -> CallbackQueryHandler:
@@ -43,7 +84,7 @@ class KeyboardHandler:
         return handler
     
     @classmethod
-    async def answer(cls, update: Update, context: CallbackContext) -> bool:
+    def answer(cls, update: Update, context: CallbackContext) -> bool:
         """Returns a boolean to determine if the callback query should be answered
 
         Args:
@@ -96,6 +137,7 @@ class KeyboardHandler:
 
 
 class PaginationKeyboardHandler(KeyboardHandler):
+    client: AsyncClient = anilist_client
     table_name: str
 
     @classmethod
@@ -103,24 +145,27 @@ class PaginationKeyboardHandler(KeyboardHandler):
         raise NotImplementedError
 
 
+    @classmethod
+    async def delete_previous_keyboard(cls, message_id: int | None, update: Update, context: CallbackContext) -> None:
+        # Only the latest keyboard of a user is kept, as the pagination state is stored per user
+        if not message_id:
+            return
+        try:
+            await context.bot.delete_message(chat_id = update.effective_chat.id, message_id = message_id)
+        except error.BadRequest:
+            # Message might not exist
+            pass
+
+
     @classmethod
     async def generate_markup(cls, current_page: int, last_page: int, update: Update, context: CallbackContext) -> InlineKeyboardMarkup:
         user = update.effective_user
         current_page = clamp(current_page, 1, last_page)
 
         user_data = await get_user_data(user.id, cls.table_name)
-        previous_keyboard, step = user_data["message_id"], user_data["step"]
+        step = user_data["step"]
 
-        if previous_keyboard:
-            try:    
-                await context.bot.delete_message(chat_id = update.effective_chat.id, message_id = previous_keyboard)
-            except error.BadRequest:
-                # Message might not exist
-                pass
-            finally:
-                await set_user_data(user.id, cls.table_name, message_id = "NULL")
-
-        pattern = cls.pattern.split(":")[0]
+        pattern = cls.pattern.pattern.split(":")[0]
         callback_data_previous = f"{pattern}:-{step}"
         callback_data_next = f"{pattern}:{step}"
 
@@ -141,8 +186,11 @@ class PaginationKeyboardHandler(KeyboardHandler):
             
         text, pagination = await cls.get_data(identifier, 1)
         text = f"1 of {pagination.last}\n\n" + text
-        kwargs = f'\'{dumps({"identifier": identifier})}\''
+        kwargs = json_dumps({"identifier": identifier})
         text = remove_unspecified_tags(text)
+
+        user_data = await get_user_data(update.effective_user.id, cls.table_name)
+        await cls.delete_previous_keyboard(user_data["message_id"], update, context)
         
         keyboard = await cls.generate_markup(pagination.current, pagination.last, update, context)
         message = await update.effective_message.reply_html(text, reply_to_message_id = update.effective_message.message_id, reply_markup = keyboard)
@@ -166,7 +214,7 @@ class PaginationKeyboardHandler(KeyboardHandler):
             return
         
         kwargs = pagination["kwargs"]
-        kwargs = loads(kwargs.strip("'"))
+        kwargs = orjson.loads(kwargs)
         kwargs["page"] = next_page
 
         text, _ = await cls.get_data(**kwargs)
@@ -174,6 +222,14 @@ class PaginationKeyboardHandler(KeyboardHandler):
         text = f"{next_page} of {pagination['last_page']}\n\n" + text
 
         keyboard = await cls.generate_markup(next_page, pagination["last_page"], update, context)
+        if query.message.message_id == pagination["message_id"]:
+            # Edit the keyboard's message in place rather than sending a new one
+            await query.edit_message_text(text, parse_mode = ParseMode.HTML, reply_markup = keyboard)
+            await set_user_data(update.effective_user.id, cls.table_name, current_page = next_page)
+            return
+
+        # The keyboard clicked belongs to someone else's search, so reply with the user's own results instead
+        await cls.delete_previous_keyboard(pagination["message_id"], update, context)
         try:
             message = await update.effective_message.reply_html(text, reply_to_message_id = pagination["reply_id"], reply_markup = keyboard)
         
@@ -195,8 +251,7 @@ class PaginationKeyboardHandler(KeyboardHandler):
 
 
 class AnimeKeyboardHandler(PaginationKeyboardHandler):
-    client = AsyncClient()
-    pattern = "anime:(-)?[0-9]+"
+    pattern = re.compile(r"anime:(-)?[0-9]+")
     table_name = DatabaseTables.KEYBOARD_ANIME
 
 
@@ -214,19 +269,14 @@ class AnimeKeyboardHandler(PaginationKeyboardHandler):
             tuple[str, tuple[int, int, int]]: Tuple containing the anime text and tuple containing three numbers which represent the pagination: total number of matched anime, current page, max page
         """        
         text = ""
-        if identifier.isnumeric():
-            animes = await cls.client.get_anime(identifier)
+        if identifier.isdecimal():
+            animes = await get_anime(cls.client, int(identifier))
             animes = [animes] if animes else animes # Make it a list if not None
             pagination = OnePage()
         
         else:
-            animes, pagination = await cls.client.search_anime(identifier, per_page, page)
-            animes_new = []
-            for anime in animes:
-                i = await cls.client.get_anime(anime.id)
-                animes_new.append(i)
-            
-            animes = animes_new
+            animes, pagination = await search_anime(cls.client, identifier, per_page, page)
+            animes = await get_all(get_anime, cls.client, animes)
         
         
         if animes:
@@ -242,27 +292,21 @@ class AnimeKeyboardHandler(PaginationKeyboardHandler):
 
 
 class CharacterKeyboardHandler(PaginationKeyboardHandler):
-    client = AsyncClient()
-    pattern = "character:(-)?[0-9]+"
+    pattern = re.compile(r"character:(-)?[0-9]+")
     table_name = DatabaseTables.KEYBOARD_CHARACTER
     
 
     @classmethod
     async def get_data(cls, identifier: str, page: int, per_page: int = 1, language: Language = Language.ENGLISH) -> tuple[str, tuple[int, int, int]]:
         text = ""
-        if identifier.isnumeric():
-            characters = await cls.client.get_character(identifier)
+        if identifier.isdecimal():
+            characters = await get_character(cls.client, int(identifier))
             characters = [characters] if characters else characters # Make it a list if not None
             pagination = OnePage()
         
         else:
-            characters, pagination = await cls.client.search_character(identifier, per_page, page)
-            characters_new = []
-            for character in characters:
-                i = await cls.client.get_character(character.id)
-                characters_new.append(i)
-            
-            characters = characters_new
+            characters, pagination = await search_character(cls.client, identifier, per_page, page)
+            characters = await get_all(get_character, cls.client, characters)
         
         
         if characters:
@@ -278,26 +322,20 @@ class CharacterKeyboardHandler(PaginationKeyboardHandler):
 
 
 class MangaKeyboardHandler(PaginationKeyboardHandler):
-    client = AsyncClient()
-    pattern = "manga:(-)?[0-9]+"
+    pattern = re.compile(r"manga:(-)?[0-9]+")
     table_name = DatabaseTables.KEYBOARD_MANGA
 
     @classmethod
     async def get_data(cls, identifier: str, page: int, per_page: int = 1, language: Language = Language.ENGLISH) -> tuple[str, tuple[int, int, int]]:
         text = ""
-        if identifier.isnumeric():
-            mangas = await cls.client.get_manga(identifier)
+        if identifier.isdecimal():
+            mangas = await get_manga(cls.client, int(identifier))
             mangas = [mangas] if mangas else mangas # Make it a list if not None
             pagination = OnePage()
         
         else:
-            mangas, pagination = await cls.client.search_manga(identifier, per_page, page)
-            mangas_new = []
-            for manga in mangas:
-                i = await cls.client.get_manga(manga.id)
-                mangas_new.append(i)
-            
-            mangas = mangas_new
+            mangas, pagination = await search_manga(cls.client, identifier, per_page, page)
+            mangas = await get_all(get_manga, cls.client, mangas)
         
         
         if mangas:
@@ -319,64 +357,57 @@ class HelpKeyboardHandler(KeyboardHandler):
         MANGA = "help:manga"
         ABOUT = "help:about"
     
-    pattern = "help:(.)*"
+    pattern = re.compile(r"help:(.)*")
+
+    # The keyboard and texts never change, so they are only built once
+    markup = InlineKeyboardMarkup([
+        [
+            InlineKeyboardButton("Anime", callback_data=HelpTopic.ANIME),
+            InlineKeyboardButton("Characters", callback_data=HelpTopic.CHARACTER),
+            InlineKeyboardButton("Manga", callback_data=HelpTopic.MANGA),
+        ],
+        [
+            InlineKeyboardButton("About", callback_data=HelpTopic.ABOUT),
+        ],
+    ])
+
+    texts: dict[HelpTopic, str] = {
+        HelpTopic.ANIME: (
+            """Use the /anime command to request anime data\n"""
+            """\n/anime <anime title>\n"""
+            """\nFor exmaple: /anime Awesome Anime"""
+        ),
+        HelpTopic.CHARACTER: (
+            """Use the /character command to request character data\n"""
+            """\n/character <character name>\n"""
+            """\nFor example: /character Cool Character"""
+        ),
+        HelpTopic.MANGA: (
+            """Use the /manga command to request character data\n"""
+            """\n/manga <manga title>\n"""
+            """For example: /manga Mid Manga\n"""
+        ),
+        HelpTopic.ABOUT: (
+            """Get information about this bot\n"""
+            """\n/about\n"""
+        ),
+    }
+
+    default_text = (
+        """I was designed to give you quick and easy access to anime and manga related information.\n"""
+        """Pick a topic you need help understanding."""
+    )
     
 
     @classmethod
     async def generate_markup(cls, update: Update, context: CallbackContext) -> InlineKeyboardMarkup:
-        TOPIC = cls.HelpTopic
-
-        keyboard = [
-            [
-                InlineKeyboardButton("Anime", callback_data=TOPIC.ANIME),
-                InlineKeyboardButton("Characters", callback_data=TOPIC.CHARACTER),
-                InlineKeyboardButton("Manga", callback_data=TOPIC.MANGA),
-            ],
-            [
-                InlineKeyboardButton("About", callback_data=TOPIC.ABOUT),
-            ],
-        ]
-
-        markup = InlineKeyboardMarkup(keyboard)
-        return markup
+        return cls.markup
     
     
     @classmethod
     async def handle(cls, update: Update, context: CallbackContext) -> None:
-        TOPIC = cls.HelpTopic
         query = update.callback_query
-        topic = query.data
-    
-
-        match topic:
-           case TOPIC.ANIME:
-                text = (
-                    """Use the /anime command to request anime data\n"""
-                    """\n/anime <anime title>\n"""
-                    """\nFor exmaple: /anime Awesome Anime"""
-                    )
-           case TOPIC.CHARACTER:
-                text = (
-                    """Use the /character command to request character data\n"""
-                    """\n/character <character name>\n"""
-                    """\nFor example: /character Cool Character"""
-                )
-           case TOPIC.MANGA:
-                text = (
-                    """Use the /manga command to request character data\n"""
-                    """\n/manga <manga title>\n"""
-                    """For example: /manga Mid Manga\n"""
-                )
-           case TOPIC.ABOUT:
-                text = (
-                    """Get information about this bot\n"""
-                    """\n/about\n"""
-                )
-           case _:
-                text = (
-                    """I was designed to give you quick and easy access to anime and manga related information.\n"""
-                    """Pick a topic you need help understanding."""
-                )
+        text = cls.texts.get(query.data, cls.default_text)
         
         if text == query.message.text:
             return
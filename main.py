@@ -1,19 +1,26 @@
 import os
 import sys
+import orjson
 
 from routes import router
 from telegram import Update
 from contextlib import asynccontextmanager
+from fastapi.responses import ORJSONResponse
 from fastapi import Depends, Header, HTTPException, FastAPI, Request
 
 from bot import Bot
-from utils import get_logger
+from keyboards import anilist_client
+from storage import flush_user_data
+from utils import get_logger, run_in_background
 from settings import get_settings
 
 
 settings = get_settings()
 logger = get_logger(__name__)
 
+# Updates waiting to be handled are limited so bursts can't exhaust memory
+MAX_PENDING_UPDATES = 1000
+
 
 def auth_bot_token(x_telegram_bot_api_secret_token: str = Header(None)) -> str:
     if x_telegram_bot_api_secret_token != settings.SECRET_TOKEN:
@@ -26,15 +33,26 @@ async def lifespan(app: FastAPI):
     bot = Bot(settings.BOT_TOKEN)
     await bot.setup(settings.SECRET_TOKEN, settings.BOT_WEB_URL+settings.WEBHOOK_URL )
 
+    async def enqueue_update(body: bytes) -> None:
+        try:
+            update = Update.de_json( orjson.loads(body), bot.application.bot )
+            await bot.application.update_queue.put(update)
+        except Exception:
+            logger.exception("Failed to queue incoming update")
+
     @router.post(settings.WEBHOOK_URL, status_code=204)
     async def webhook(request: Request, token: str = Depends(auth_bot_token)) -> None:
-        """Handle incoming updates by putting them into the `update_queue`"""
-        update_json = await request.json()
-        update = Update.de_json( update_json, bot.application.bot )
-        await bot.application.update_queue.put(update)
+        """Handle incoming updates by putting them into the `update_queue` in the background, so the request returns immediately"""
+        if bot.application.update_queue.qsize() >= MAX_PENDING_UPDATES:
+            # Telegram retries the update later
+            logger.warning("Too many pending updates, rejecting update")
+            raise HTTPException(status_code=429, detail="Too many pending updates")
+
+        body = await request.body()
+        run_in_background( enqueue_update(body) )
 
     app.include_router(router)
-    async with bot.application:
+    async with bot.application, anilist_client:
         # Runs when app starts
         logger.info(f"\n🚀 Bot starting up ...\nDebugging is {'enabled' if settings.DEBUG else 'disabled'}")
         await bot.application.start()
@@ -44,9 +62,10 @@ async def lifespan(app: FastAPI):
         # Runs after app shuts down
         logger.info("\n⛔ Bot shutting down ...\n")
         await bot.application.stop()
+        await flush_user_data()
         
         if bot.application.bot_data.get("restart", False):
             os.execl(sys.executable, sys.executable, *sys.argv)
 
 
-app = FastAPI( title = "BotFastAPI", description = "A webhook api for a telegram anime bot", lifespan = lifespan )
+app = FastAPI( title = "BotFastAPI", description = "A webhook api for a telegram anime bot", lifespan = lifespan, default_response_class = ORJSONResponse )
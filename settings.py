@@ -3,6 +3,8 @@ from telegram.constants import MessageLimit
 from environs import Env
 from enum import IntEnum, StrEnum
 from logging import INFO, WARNING
+from functools import lru_cache, partial
+from dataclasses import dataclass, field
 
 env = Env()
 env.read_env()
@@ -27,30 +29,36 @@ class DatabaseTables(StrEnum):
     KEYBOARD_CHARACTER = "keyboard_character"
 
 
+@dataclass(frozen = True, slots = True)
 class Settings:
-    PORT: int = env.int("PORT")
-    HOST: str = env.str("HOST", "0.0.0.0")
-    DB_PATH: str = env.str("DB_PATH")
-    DEBUG: bool = env.bool("DEBUG", False)
-    LOG_LEVEL: int = INFO if DEBUG else WARNING
-
-    BOT_TOKEN: str = env.str("BOT_TOKEN")
-    SECRET_TOKEN: str = env.str("SECRET_TOKEN")
+    PORT: int = field(default_factory = partial(env.int, "PORT"))
+    HOST: str = field(default_factory = partial(env.str, "HOST", "0.0.0.0"))
+    DB_PATH: str = field(default_factory = partial(env.str, "DB_PATH"))
+    DEBUG: bool = field(default_factory = partial(env.bool, "DEBUG", False))
+
+    BOT_TOKEN: str = field(default_factory = partial(env.str, "BOT_TOKEN"))
+    SECRET_TOKEN: str = field(default_factory = partial(env.str, "SECRET_TOKEN"))
     
-    BOT_WEB_URL: str = env.str("BOT_WEB_URL")
-    HEALTH_URL: str= env.str("HEALTH_URL", "/health/")
-    WEBHOOK_URL: str = env.str("WEBHOOK_URL", "/webhook/")
+    BOT_WEB_URL: str = field(default_factory = partial(env.str, "BOT_WEB_URL"))
+    HEALTH_URL: str = field(default_factory = partial(env.str, "HEALTH_URL", "/health/"))
+    WEBHOOK_URL: str = field(default_factory = partial(env.str, "WEBHOOK_URL", "/webhook/"))
 
-    LOG_CHAT_IDS: list[int] = [ int(i.strip()) for i in env.list("LOG_CHAT_IDS", []) ]
-    DEVELOPER_CHAT_IDS: list[int] = [ int(i.strip()) for i in env.list("DEVELOPER_CHAT_IDS", []) ]
+    LOG_CHAT_IDS: frozenset[int] = field(default_factory = lambda: frozenset( int(i.strip()) for i in env.list("LOG_CHAT_IDS", []) ))
+    DEVELOPER_CHAT_IDS: frozenset[int] = field(default_factory = lambda: frozenset( int(i.strip()) for i in env.list("DEVELOPER_CHAT_IDS", []) ))
 
     MIN_MESSAGE_LENGTH: int = MessageLimit.MIN_TEXT_LENGTH
     MAX_MESSAGE_LENGTH: int = MessageLimit.MAX_TEXT_LENGTH
-    ALLOWED_TAGS = [ "a", "b", "code", "i", "pre" ]
+    ALLOWED_TAGS: tuple[str, ...] = ( "a", "b", "code", "i", "pre" )
+
+    @property
+    def LOG_LEVEL(self) -> int:
+        return INFO if self.DEBUG else WARNING
 
 
 
 
+# Environment variables are only read once, every module shares the same settings
+@lru_cache(maxsize = 1)
 def get_settings() -> Settings:
     settings = Settings()
     return settings
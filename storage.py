@@ -1,16 +1,50 @@
-from utils import get_logger
+from os import cpu_count
+from time import monotonic
+from collections import OrderedDict
+from functools import lru_cache
+from pathlib import Path
+from typing import AsyncIterator
+from contextlib import asynccontextmanager
+from asyncio import gather, sleep, Lock, Queue, Task, to_thread
+
+from utils import get_logger, run_in_background
 from sqlite3 import connect, Cursor, Connection
 from settings import get_settings, Language, DatabaseTables
 
 
-data_cache = {}
 settings = get_settings()
 logger = get_logger(__name__)
 
+# Changes waiting to be written to the database, keyed by user id and table name
+pending_changes: dict[tuple[int, str], dict] = {}
+flush_task: Task | None = None
+FLUSH_DELAY = 0.1
+RETRY_DELAY = 5
+
+
+# Applied to every connection: WAL lets reads run alongside a write and only syncs on checkpoints
+pragmas = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-20000",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA foreign_keys=ON",
+    "PRAGMA wal_autocheckpoint=1000",
+)
+
+
+def apply_pragmas(connection: Connection) -> None:
+    for pragma in pragmas:
+        connection.execute(pragma)
+
 
 def setup_storage() -> tuple[Connection, Cursor, dict[str, tuple]]:
-    # Setup database
-    connection = connect(settings.DB_PATH)
+    # Setup database, this connection is the only one that writes
+    # Queries run in worker threads so they don't block the event loop
+    # Transactions are opened explicitly, so the driver never leaves one open
+    connection = connect(settings.DB_PATH, check_same_thread = False, isolation_level = None)
+    apply_pragmas(connection)
     cursor = connection.cursor()
 
 
@@ -28,57 +62,226 @@ def setup_storage() -> tuple[Connection, Cursor, dict[str, tuple]]:
     column_names = { table.value: tuple(i[1] for i in cursor.execute(f"""PRAGMA table_info({table.name})""").fetchall()) for table in DatabaseTables }
     return connection, cursor, column_names
 
+class UserDataCache(OrderedDict):
+    """Caches the data of users, evicting the least recently used users when full and users that were loaded more than ttl seconds ago"""
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        super().__init__()
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.expiry_times: dict[int, float] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get_user(self, user_id: int) -> dict | None:
+        user_data = self.get(user_id)
+        if user_data is None or self.expiry_times[user_id] <= monotonic():
+            self.misses += 1
+            self.remove_user(user_id)
+            return None
+        
+        self.hits += 1
+        self.move_to_end(user_id)
+        return user_data
+
+    def set_user(self, user_id: int, user_data: dict) -> None:
+        self[user_id] = user_data
+        self.move_to_end(user_id)
+        self.expiry_times[user_id] = monotonic() + self.ttl
+
+        while len(self) > self.maxsize:
+            user_id, _ = self.popitem(last = False)
+            self.expiry_times.pop(user_id, None)
+
+    def remove_user(self, user_id: int) -> None:
+        self.pop(user_id, None)
+        self.expiry_times.pop(user_id, None)
+
+
+data_cache = UserDataCache(maxsize = 10_000, ttl = 3600)
 connection, cursor, column_names = setup_storage()
+write_lock = Lock()
+
+# Statements are built once per table, table names only ever come from DatabaseTables
+insert_statements = { tablename: f"""INSERT OR IGNORE INTO {tablename} (user_id) VALUES (?)""" for tablename in column_names }
+select_statements = { tablename: f"""SELECT * FROM {tablename} WHERE user_id=?""" for tablename in column_names }
+valid_tables = frozenset(column_names)
+# The column names cached for each table, without the user_id which is always the first column
+data_column_names = { tablename: columns[1:] for tablename, columns in column_names.items() }
+
+
+@lru_cache(maxsize = 128)
+def get_update_statement(tablename: str, columns: tuple[str, ...]) -> str:
+    """Builds a parameterized UPDATE statement for the given columns of a table.
+    The same string is returned for the same columns, so sqlite can reuse its prepared statement.
+
+    Args:
+        tablename (str): The table to update
+        columns (tuple[str, ...]): The columns to set
+
+    Raises:
+        KeyError: If the table or any of the columns do not exist
+
+    Returns:
+        str: The UPDATE statement, with the column values followed by the user id as parameters
+    """
+    if tablename not in valid_tables:
+        raise KeyError(f"{tablename} not a valid user data table")
+    for column in columns:
+        if column not in column_names[tablename]:
+            raise KeyError(column)
+
+    changes_string = ", ".join(f"""{column}=?""" for column in columns)
+    return f"""UPDATE {tablename} SET {changes_string} WHERE user_id=?"""
+
+
+class ReadPool:
+    """A pool of read only connections to the database, so reads can run concurrently with each other and with writes"""
+    
+    def __init__(self, size: int) -> None:
+        self.connections: Queue[Connection] = Queue()
+        uri = Path(settings.DB_PATH).resolve().as_uri() + "?mode=ro"
+        for _ in range(size):
+            read_connection = connect(uri, uri = True, check_same_thread = False)
+            apply_pragmas(read_connection)
+            self.connections.put_nowait(read_connection)
+
+    @asynccontextmanager
+    async def acquire(self) -> AsyncIterator[Connection]:
+        read_connection = await self.connections.get()
+        try:
+            yield read_connection
+        finally:
+            self.connections.put_nowait(read_connection)
+
+read_pool = ReadPool(cpu_count() or 1)
+
+
+async def read_one(sql_string: str, parameters: tuple = ()) -> tuple | None:
+    async with read_pool.acquire() as read_connection:
+        return await to_thread( lambda: read_connection.execute(sql_string, parameters).fetchone() )
 
 
-async def setup_data_cache(user_id: int) -> None:
+async def write(sql_string: str, parameters: tuple = ()) -> None:
+    await write_many([ (sql_string, parameters) ])
+
+
+async def write_many(statements: list[tuple[str, tuple]]) -> None:
+    """Executes statements in a single transaction, so they share one commit"""
+    def execute_and_commit():
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            for sql_string, parameters in statements:
+                cursor.execute(sql_string, parameters)
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        cursor.execute("COMMIT")
+    
+    async with write_lock:
+        await to_thread(execute_and_commit)
+
+
+async def execute(sql_string: str) -> list[tuple]:
+    """Executes an arbitrary statement on the writing connection and returns its rows"""
+    async with write_lock:
+        return await to_thread( lambda: cursor.execute(sql_string).fetchall() )
+
+
+async def setup_data_cache(user_id: int) -> dict:
     user_data = {}
+    tablenames = [ table.value for table in DatabaseTables ]
     
-    # Set the user's cache to the values gotten from the databases for each table
-    for table in DatabaseTables:
-        tablename = table.value
-        
-        # Insert an entry for the user in the table
-        user_data[tablename] = {}
-        sql_string_format = """INSERT OR IGNORE INTO {tablename} (user_id) VALUES (?)"""
-        sql_string = sql_string_format.format(tablename = tablename)
+    # Insert an entry for the user in every table, in one transaction
+    await write_many([ (insert_statements[tablename], (user_id,)) for tablename in tablenames ])
+    rows = await gather( *( read_one(select_statements[tablename], (user_id,)) for tablename in tablenames ) )
 
-        cursor.execute(sql_string, (user_id,))
-        connection.commit()
-        
-        # Iterate over the column name and column value and set them in the cache, ignoring the user_id which is indexed at 0
-        for key, value in zip(column_names[tablename][1:], cursor.execute(f"""SELECT * FROM {tablename} WHERE user_id=?""", (user_id,)).fetchone()[1:] ):
-            user_data[tablename][key] = value
+    # Set the user's cache to the values gotten from the databases for each table, ignoring the user_id which is indexed at 0
+    for tablename, row in zip(tablenames, rows):
+        user_data[tablename] = dict(zip(data_column_names[tablename], row[1:]))
+        # The user might have been evicted from the cache before their changes were written
+        user_data[tablename].update( pending_changes.get((user_id, tablename), {}) )
             
-    data_cache[user_id] = user_data
-    
+    data_cache.set_user(user_id, user_data)
+    return user_data
 
-async def set_user_data(user_id: int, tablename: str, **changes):
-    if user_id not in data_cache:
-        await setup_data_cache(user_id)
+
+async def load_user_data(user_id: int) -> dict:
+    user_data = data_cache.get_user(user_id)
+    if user_data is None:
+        user_data = await setup_data_cache(user_id)
+    return user_data
     
-    user_data = data_cache[user_id]
-    assert tablename in user_data, f"{tablename} not a valid user data table"
 
-    changes_string =  ", ".join(f"""{key}={changes[key]}""" for key in changes)
-    sql_string_format = """UPDATE {tablename} SET {changes_string} WHERE user_id=?"""
-    sql_string = sql_string_format.format(tablename = tablename, changes_string = changes_string)
-    logger.info(f"\n{sql_string}\n")
+async def set_user_data(user_id: int, tablename: str, **changes):
+    if tablename not in valid_tables:
+        raise KeyError(f"{tablename} not a valid user data table")
+    user_data = await load_user_data(user_id)
 
-    cursor.execute(sql_string, (user_id,))
-    connection.commit()
+    # Check the columns before accepting the changes, the statement is cached for the flush
+    get_update_statement(tablename, tuple(changes))
 
     for key in changes:
         user_data[tablename][key] = changes[key]
 
+    # The cache is updated immediately, writes to the database are batched by the flush
+    pending_changes.setdefault((user_id, tablename), {}).update(changes)
+    schedule_flush()
+
+
+def schedule_flush() -> None:
+    global flush_task
+    if flush_task is None or flush_task.done():
+        flush_task = run_in_background( flush_later() )
+
+
+async def flush_later(delay: float = FLUSH_DELAY) -> None:
+    global flush_task
+    await sleep(delay)
+    try:
+        await flush_user_data()
+    except Exception:
+        logger.exception("Failed to write user data to the database, retrying")
+        flush_task = run_in_background( flush_later(RETRY_DELAY) )
+        return
+
+    # Changes made while writing weren't part of this flush
+    if pending_changes:
+        flush_task = run_in_background( flush_later() )
+
+
+async def flush_user_data() -> None:
+    """Writes all pending user data changes to the database in one transaction"""
+    if not pending_changes:
+        return
+    
+    # The changes stay pending until they are committed, so cache reloads still apply them
+    changes = { key: dict(table_changes) for key, table_changes in pending_changes.items() }
+
+    statements = []
+    for (user_id, tablename), table_changes in changes.items():
+        sql_string = get_update_statement(tablename, tuple(table_changes))
+        parameters = (*table_changes.values(), user_id)
+        logger.info(f"\n{sql_string} {parameters}\n")
+        statements.append( (sql_string, parameters) )
+
+    await write_many(statements)
+
+    # Only the written values are removed, edits made during the write stay pending
+    for key, table_changes in changes.items():
+        current_changes = pending_changes.get(key, {})
+        for column, value in table_changes.items():
+            if column in current_changes and current_changes[column] == value:
+                del current_changes[column]
+        if not current_changes:
+            pending_changes.pop(key, None)
+
 
 # Return cached data in order of definition in database
 async def get_user_data(user_id: int, tablename: str) -> dict:
-    if user_id not in data_cache:
-        await setup_data_cache(user_id)
-    
-    user_data = data_cache[user_id]
-    assert tablename in user_data, f"{tablename} not a valid user data table"
+    if tablename not in valid_tables:
+        raise KeyError(f"{tablename} not a valid user data table")
+    user_data = await load_user_data(user_id)
     table = user_data[tablename]
     return table
 
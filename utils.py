@@ -1,4 +1,11 @@
 import re
+import orjson
+from time import monotonic
+from typing import Coroutine
+from asyncio import create_task, Task
+from itertools import islice
+from functools import lru_cache, partial, wraps
+from collections import OrderedDict
 from bs4 import BeautifulSoup
 from logging import getLogger, basicConfig
 
@@ -7,6 +14,7 @@ from settings import get_settings, Language
 
 
 settings = get_settings()
+pending_tasks: set[Task] = set()
 basicConfig( format = "%(asctime)s - %(name)s -%(levelname)s - %(message)s", level = settings.LOG_LEVEL )
 
 
@@ -16,16 +24,91 @@ def get_logger(name: str):
 logger = get_logger(__name__)
 
 
+sensitive_keys = ( "id", "last_name", "first_name", "username" )
+sensitive_info_regex = re.compile( "|".join(f'"{re.escape(key)}": .*,' for key in sensitive_keys) )
+
+
 def remove_update_sensitive_info(update: str) -> str:
-    pattern = '(' + ')|('.join(["\"id\": .*,", "\"last_name\": \".*\",", "\"first_name\": \".*\",", "\"username\": \".*\","]) + ')'
-    result = re.sub(pattern, "", update)
+    result = sensitive_info_regex.sub("", update)
     return result
 
 
+def run_in_background(coroutine: Coroutine) -> Task:
+    """Schedules a coroutine without waiting for it to finish.
+
+    Args:
+        coroutine (Coroutine): The coroutine to run
+
+    Returns:
+        Task: The scheduled task
+    """
+    # Keep a reference to the task so it is not garbage collected before it is done
+    task = create_task(coroutine)
+    pending_tasks.add(task)
+    task.add_done_callback(pending_tasks.discard)
+    return task
+
+
+def json_dumps(obj: object, indent: bool = False) -> str:
+    """Serializes an object to a JSON string using orjson
+
+    Args:
+        obj (object): The object to serialize
+        indent (bool, optional): Indent the output with two spaces. Defaults to False.
+
+    Returns:
+        str: The JSON string
+    """
+    option = orjson.OPT_NON_STR_KEYS | orjson.OPT_INDENT_2 if indent else orjson.OPT_NON_STR_KEYS
+    return orjson.dumps(obj, option = option).decode()
+
+
 def clamp(value: int, least: int, most: int):
     return max( least, min(value, most) )
 
 
+def async_ttl_cache(maxsize: int = 128, ttl: float = 3600):
+    """Caches the results of a coroutine function, evicting the least recently used results when full and results older than ttl
+
+    Args:
+        maxsize (int, optional): The maximum number of results to keep. Defaults to 128.
+        ttl (float, optional): The number of seconds a result stays valid. Defaults to 3600.
+
+    Returns:
+        Callable: The decorator
+    """
+    def decorator(func):
+        cache = OrderedDict()
+
+        @wraps(func)
+        async def wrapper(*args):
+            now = monotonic()
+            if args in cache:
+                expires, result = cache[args]
+                if expires > now:
+                    cache.move_to_end(args)
+                    return result
+                del cache[args]
+
+            result = await func(*args)
+            # Empty results are not cached, they might come from a failed request
+            if result is None:
+                return result
+
+            cache[args] = (now + ttl, result)
+            if len(cache) > maxsize:
+                cache.popitem(last = False)
+            return result
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+    return decorator
+
+
+tag_regex = re.compile(r"<[^>]*>")
+tag_name_regex = re.compile(r"</?([a-zA-Z][a-zA-Z0-9]*)")
+
+
 def complete_html_tags(html_string: str) -> str:
     """Completes the html tags in a string, closes tags and adds opening tags
 
@@ -36,22 +119,10 @@ def complete_html_tags(html_string: str) -> str:
         str: The edited string
     """
     stack = []
-    index = 0
-    result = []
     completed_html = []
 
     # Find all tags in the HTML string
-    while index < len(html_string):
-        if html_string[index] == '<':
-            tag_start = index
-            index += 1
-            while index < len(html_string) and html_string[index] != '>':
-                index += 1
-            if index < len(html_string):
-                tag_end = index + 1
-                tag = html_string[tag_start:tag_end]
-                result.append(tag)
-        index += 1
+    result = tag_regex.findall(html_string)
 
     # Process each tag
     for tag in result:
@@ -76,6 +147,38 @@ def complete_html_tags(html_string: str) -> str:
 
 
 
+def balance_html_tags(html_string: str, open_tags: list[str]) -> tuple[str, list[str]]:
+    """Balances the html tags of a chunk without parsing it, reopening the tags left open by the previous chunk and closing the ones it leaves open
+
+    Args:
+        html_string (str): The html chunk to balance
+        open_tags (list[str]): The opening tags left open by the previous chunk
+
+    Returns:
+        tuple[str, list[str]]: The balanced chunk and the opening tags it leaves open
+    """
+    stack = list(open_tags)
+
+    def balance(match: re.Match) -> str:
+        tag = match.group()
+        name = tag_name_regex.match(tag)
+        if name is None:
+            return tag
+        if not tag.startswith("</"):
+            stack.append(tag)
+            return tag
+        if stack and tag_name_regex.match(stack[-1]).group(1) == name.group(1):
+            stack.pop()
+            return tag
+        # Unmatched closing tags are dropped, as telegram rejects them
+        return ""
+
+    body = tag_regex.sub(balance, html_string)
+    closing_tags = "".join( f"</{tag_name_regex.match(tag).group(1)}>" for tag in reversed(stack) )
+    return "".join(open_tags) + body + closing_tags, stack
+
+
+
 def chunkify_text(text: str, chunk_length: int = settings.MAX_MESSAGE_LENGTH) -> list[str]:
     """Splits a string into chunks based on maximum length specified
     
@@ -86,40 +189,64 @@ def chunkify_text(text: str, chunk_length: int = settings.MAX_MESSAGE_LENGTH) ->
     Returns:
         list[str]: The string, split into chunks
     """
-    chunks = []
-    for start in range(0, len(text), chunk_length):
-        end = start + chunk_length
-        chunk = text[start:end] if end < len(text) else text[start:]
-        chunks.append(chunk)
+    chunks = [ text[start:start + chunk_length] for start in range(0, len(text), chunk_length) ]
     return chunks
 
 
-def chunkify_html_text(text: str, chunk_length: int = settings.MAX_MESSAGE_LENGTH) -> list[str]:
+def chunkify_html_text(text: str, chunk_length: int = settings.MAX_MESSAGE_LENGTH, fast: bool = False) -> list[str]:
     """Splits a html string into chunks based on maximum length specified
     
     Args:
         text (str): The html string to split into chunks
         chunk_length (int, optional): The length of each chunk. Defaults to settings.MAX_MESSAGE_LENGTH.
+        fast (bool, optional): Remove unspecified tags with a regex and balance the tags of each chunk without BeautifulSoup. Defaults to False.
 
     Returns:
         list[str]: The string, split into chunks
     """
 
     chunks = []
+    open_tags = []
+    if fast:
+        text = remove_unspecified_tags_regex(text)
+
+    start = 0
     length = len(text)
     buffer_length = int(chunk_length * 0.8)
 
-    for start in range(0, length, buffer_length):
+    while start < length:
         end = start + buffer_length
-        chunk = text[start:end] if end < length else text[start:]
-        chunk = "<pre></pre>" if len(chunk.strip()) == 0 else chunk
-        soup = BeautifulSoup(chunk, features = "html.parser")
-        chunk = remove_unspecified_tags(soup.decode())
-        chunks.append(chunk)
+        # Don't split a chunk in the middle of a tag, end it before the tag instead
+        tag_start = text.rfind("<", start, end)
+        if end < length and tag_start > start and tag_start > text.rfind(">", start, end):
+            end = tag_start
+
+        chunk = text[start:end]
+        start = end
+        if fast:
+            # Tags left open where the chunk was split are closed, then reopened in the next chunk
+            if len(tag_regex.sub("", chunk).strip()) == 0:
+                continue
+            chunk, open_tags = balance_html_tags(chunk, open_tags)
+        else:
+            chunk = "<pre></pre>" if len(chunk.strip()) == 0 else chunk
+            # Parsing closes any tags left open where the chunk was split
+            soup = BeautifulSoup(chunk, features = "html.parser")
+            chunk = remove_unspecified_tags(soup)
+
+        # A chunk holding only closing tags is empty once parsed
+        if chunk:
+            chunks.append(chunk)
 
     return chunks
  
 
+@lru_cache(maxsize = 16)
+def get_unspecified_tags_regex(tags: tuple[str, ...]) -> re.Pattern:
+    # Compiled once for each set of allowed tags
+    return re.compile(r"</?(?!(?:" + "|".join(tags) + r")\b)[a-z](?:[^>\"']|\"[^\"]*\"|'[^']*')*>")
+
+
 def remove_unspecified_tags_regex(text: str, tags: list[str] = settings.ALLOWED_TAGS) -> str:
     """Removes html tags that are not in the given list, completely.
     About 8x faster than using BeautifulSoup
@@ -134,77 +261,135 @@ def remove_unspecified_tags_regex(text: str, tags: list[str] = settings.ALLOWED_
     if tags is None:
         return text
     else:
-        result = re.sub(r"</?(?!(?:" + "|".join(tags) + r")\b)[a-z](?:[^>\"']|\"[^\"]*\"|'[^']*')*>", '', text)
+        result = get_unspecified_tags_regex(tuple(tags)).sub('', text)
         return result
 
 
-def remove_unspecified_tags(text: str, tags: list[str] = settings.ALLOWED_TAGS) -> str:
+def remove_unspecified_tags(text: str | BeautifulSoup, tags: list[str] = settings.ALLOWED_TAGS) -> str:
     """Removes html tags that are not in the given list, completely, using BeautifulSoup
     Slower than using regex but more robust.
 
     Args:
-        text (str): The string to perfrom the operation on
+        text (str | BeautifulSoup): The string to perfrom the operation on, or the already parsed string
         tags (list[str], optional): The tags that should remain in the string. Defaults to settings.ALLOWED_TAGS.
 
     Returns:
         str: The string with unlisted tags removed
     """
-    if not tags or len(text.strip()) == 0:
+    if isinstance(text, BeautifulSoup):
+        soup = text
+        if not tags:
+            return soup.decode()
+        for br in soup.find_all("br"):
+            br.replace_with("\n")
+    
+    elif not tags or len(text.strip()) == 0:
         return text
+    
     else:
-        def recurse(element: BeautifulSoup):            
-            if element.name is None:
-                return
-            
-            for child in element.children:
-                recurse(child)
-            if element.name not in tags:
-                element.unwrap()
-        
         text = text.replace("<br/>", "\n")
         soup = BeautifulSoup(text, features = "html.parser")
-        for child in soup.children:
-            recurse(child)
-        result = soup.decode()
-        return result
 
-
-def format_anime(anime, language: Language = Language.ENGLISH) -> str:
-    titles = "\n".join(get_media_titles(anime, language)).replace("\n\n", "\n")
-    characters = "\n\n".join([ "\n ".join(get_character_names(character, language)) for character in get_main_characters(anime) ])
-    text = (
-            f"ID: {anime.id}\n\n"
-            f"<b>Titles</b>\n"
-            f"{titles}\n\n"
-            "<b>Description</b>\n"
-            f"<pre>  <i>{getattr(anime, 'description_short', getattr(anime, 'description', 'No description'))}</i></pre>\n\n"
-            
-            "<b>Details</b>\n"
-            f"Country: {getattr(anime, 'country', 'Not known')}\n"
-            f"Episodes: {getattr(anime, 'episodes', 'Not known')}\n"
-            f"Format: {getattr(anime, 'format', 'Not known')}\n"
-            f"Source: {getattr(anime, 'source', '').title()}\n"
-            
-            f"Status: {getattr(anime, 'status', 'Status not available').title()}\n"
-            f"Season: {getattr(getattr(anime, 'season', 'Not known'), 'name', 'Not known')}\n"
-            f"Started: {getattr(getattr(anime, 'start_date', ''), 'year', 'Not known')}\n"
-            f"Ended: {getattr(getattr(anime, 'end_date', ''), 'year', 'Not known')}\n\n"
-
-            "<b>Extra Info</b>\n"
-            f"<i>Genres</i>: {', '.join(getattr(anime, 'genres', []))}\n\n"
-            f"<i>Tags</i>: {', '.join(getattr(anime, 'tags', []))}\n\n"
-            f"<i>Studios</i>: {', '.join(getattr(anime, 'studios', []))}\n\n"
-            
-            f"<b>Main characters</b>\n {characters}\n\n"
-            f"Url: <a href='{getattr(anime, 'url', '')}' title='Anilist url'>{getattr(anime, 'url', '')}</a>\n"
-        )
+    # Walk the tree with a stack rather than recursion, deeply nested html could hit the recursion limit
+    allowed_tags = frozenset(tags)
+    stack = list(soup.children)
+    while stack:
+        element = stack.pop()
+        if element.name is None:
+            continue
+        
+        stack.extend(element.children)
+        if element.name not in allowed_tags:
+            element.unwrap()
     
+    result = soup.decode()
+    return result
+
+
+def build_media_template(show_studios: bool) -> str:
+    return (
+        "ID: {id}\n\n"
+        "<b>Titles</b>\n"
+        "{titles}\n\n"
+        "<b>Description</b>\n"
+        "<pre>  <i>{description}</i></pre>\n\n"
+        
+        "<b>Details</b>\n"
+        "Country: {country}\n"
+        "Episodes: {episodes}\n"
+        "Format: {format}\n"
+        "Source: {source}\n"
+        
+        "Status: {status}\n"
+        "Season: {season}\n"
+        "Started: {started}\n"
+        "Ended: {ended}\n\n"
+
+        "<b>Extra Info</b>\n"
+        "<i>Genres</i>: {genres}\n\n"
+        "<i>Tags</i>: {tags}\n\n"
+        + ( "<i>Studios</i>: {studios}\n\n" if show_studios else "" ) +
+        
+        "<b>Main characters</b>\n {characters}\n\n"
+        "Url: <a href='{url}' title='Anilist url'>{url}</a>\n"
+    )
+
+anime_template = build_media_template(show_studios = True)
+manga_template = build_media_template(show_studios = False)
+
+
+def get_year(obj, attribute: str) -> int | str:
+    return getattr(getattr(obj, attribute, None), 'year', 'Not known')
+
+
+def get_media_details(media, language: Language = Language.ENGLISH) -> dict:
+    """Collects the values shown for an anime or manga, used to fill in their templates
+
+    Args:
+        media: The anime or manga
+        language (Language, optional): The language of the titles and character names. Defaults to Language.ENGLISH.
+
+    Returns:
+        dict: The values, keyed by their names in the templates
+    """
+    return {
+        "id": media.id,
+        "titles": "\n".join(get_media_titles(media, language)).replace("\n\n", "\n"),
+        "description": getattr(media, 'description_short', getattr(media, 'description', 'No description')),
+        "country": getattr(media, 'country', 'Not known'),
+        "episodes": getattr(media, 'episodes', 'Not known'),
+        "format": getattr(media, 'format', 'Not known'),
+        "source": getattr(media, 'source', '').title(),
+        "status": getattr(media, 'status', 'Status not available').title(),
+        "season": getattr(getattr(media, 'season', None), 'name', 'Not known'),
+        "started": get_year(media, 'start_date'),
+        "ended": get_year(media, 'end_date'),
+        "genres": ', '.join(getattr(media, 'genres', [])),
+        "tags": ', '.join(getattr(media, 'tags', [])),
+        "studios": ', '.join(getattr(media, 'studios', [])),
+        "characters": "\n\n".join([ "\n ".join(get_character_names(character, language)) for character in get_main_characters(media) ]),
+        "url": getattr(media, 'url', ''),
+    }
+
+
+def format_media(media, language: Language = Language.ENGLISH, *, show_studios: bool) -> str:
+    template = anime_template if show_studios else manga_template
+    text = template.format_map( get_media_details(media, language) )
     return text
 
+format_anime = partial(format_media, show_studios = True)
+format_manga = partial(format_media, show_studios = False)
+
+
+# Anilist spoiler and bold markers, replaced in a single pass
+description_markup = { "!~": "\n  ", "~!": "\n  ", "__": "" }
+description_markup_regex = re.compile(r"!~|~!|__")
+
 
 def format_character(character, language: Language = Language.ENGLISH) -> str:
     names = "\n".join(get_character_names(character)).replace("\n\n", "\n")
-    description = getattr(character, 'description_short', getattr(character, 'description', 'No description').replace('!~','\n  ').replace('~!','\n  ').replace('__', ''))
+    description = getattr(character, 'description_short', getattr(character, 'description', 'No description'))
+    description = description_markup_regex.sub(lambda match: description_markup[match.group(0)], description)
     text = (
         f"ID: {character.id}\n\n"
         "<b>Names</b>\n"
@@ -216,7 +401,7 @@ def format_character(character, language: Language = Language.ENGLISH) -> str:
         "<b>Details</b>\n"
         f"Gender: {getattr(character, 'gender', 'Not known')}\n"
         f"Age: {getattr(character, 'age', 'Not known')}\n"
-        f"DOB: {getattr(getattr(character, 'birth_date', ''), 'year', 'Not known')}\n"
+        f"DOB: {get_year(character, 'birth_date')}\n"
         f"Role: {getattr(character, 'role', 'Not known')}\n\n"
 
         "<b>Appearances</b>\n"
@@ -227,82 +412,56 @@ def format_character(character, language: Language = Language.ENGLISH) -> str:
     return text
 
 
-def format_manga(manga, language: Language = Language.ENGLISH) -> str:
-    titles = "\n".join(get_media_titles(manga, language)).replace("\n\n", "\n")
-    characters = "\n\n".join([ "\n ".join(get_character_names(character, language)) for character in get_main_characters(manga) ])
-    text = (
-        f"ID: {manga.id}\n\n"
-        f"<b>Titles</b>\n"
-        f"{titles}\n\n"
-        "<b>Description</b>\n"
-        f"<pre>  <i>{getattr(manga, 'description_short', getattr(manga, 'description', 'No description'))}</i></pre>\n\n"
-        
-        "<b>Details</b>\n"
-        f"Country: {getattr(manga, 'country', 'Not known')}\n"
-        f"Episodes: {getattr(manga, 'episodes', 'Not known')}\n"
-        f"Format: {getattr(manga, 'format', 'Not known')}\n"
-        f"Source: {getattr(manga, 'source', '').title()}\n"
-        
-        f"Status: {getattr(manga, 'status', 'Status not available').title()}\n"
-        f"Season: {getattr(getattr(manga, 'season', 'Not known'), 'name', 'Not known')}\n"
-        f"Started: {getattr(getattr(manga, 'start_date', ''), 'year', 'Not known')}\n"
-        f"Ended: {getattr(getattr(manga, 'end_date', ''), 'year', 'Not known')}\n\n"
+# The order titles and names are listed in for each language
+title_orders = {
+    Language.ROMAJI: ( "romaji", "english", "native" ),
+    Language.JAPANESE: ( "native", "english", "romaji" ),
+    Language.ENGLISH: ( "english", "romaji", "native" ),
+}
 
-        "<b>Extra Info</b>\n"
-        f"<i>Genres</i>: {', '.join(getattr(manga, 'genres', []))}\n\n"
-        f"<i>Tags</i>: {', '.join(getattr(manga, 'tags', []))}\n\n"
-        
-        f"<b>Main characters</b>\n {characters}\n\n"
-        f"Url: <a href='{getattr(manga, 'url', '')}' title='Anilist url'>{getattr(manga, 'url', '')}</a>"
-        )
-    return text
+name_orders = {
+    Language.JAPANESE: ( "native", "alternative" ),
+    Language.ENGLISH: ( "alternative", "native" ),
+    Language.ROMAJI: ( "alternative", "native" ),
+}
 
 
 def get_media_titles(media: dict, language: Language = Language.ENGLISH) -> list[str]:
-    romaji = getattr(getattr(media, "title", ""), "romaji", "No romaji title" )
-    native = getattr(getattr(media, "title", ""), "native", "No japanese title" )
-    english = getattr(getattr(media, "title", ""), "english", "No english title")
-
-    match language:
-        case Language.ROMAJI:
-            titles = { romaji, english, native }
-        case Language.JAPANESE:
-            titles = { native, english, romaji }
-        case Language.ENGLISH:
-            titles = { english, romaji, native }
-        case _:
-            raise Exception ("'{language}' is not a valid language")
-    return list(titles)
+    order = title_orders.get(language)
+    if order is None:
+        raise Exception (f"'{language}' is not a valid language")
+
+    title = getattr(media, "title", None)
+    titles = {
+        "romaji": getattr(title, "romaji", "No romaji title" ),
+        "native": getattr(title, "native", "No japanese title" ),
+        "english": getattr(title, "english", "No english title"),
+    }
+    # Remove duplicate titles, keeping the order
+    return list(dict.fromkeys( titles[key] for key in order ))
 
 
 def get_character_names(character: dict, language: Language = Language.ENGLISH) -> list[str]:
-    native = getattr(getattr(character, "name", ""), "native", "No japanese name" )
-    alternative = getattr(getattr(character, "name", ""), "full", "No english name" )
+    order = name_orders.get(language)
+    if order is None:
+        raise Exception (f"'{language}' is not a valid language")
 
-    match language:
-        case Language.JAPANESE:
-            names = { native, alternative }
-        case Language.ENGLISH | Language.ROMAJI:
-            names = { alternative, native }
-        case _:
-            raise Exception ("'{language}' is not a valid language")
-    return list(names)
+    name = getattr(character, "name", None)
+    names = {
+        "native": getattr(name, "native", "No japanese name" ),
+        "alternative": getattr(name, "full", "No english name" ),
+    }
+    # Remove duplicate names, keeping the order
+    return list(dict.fromkeys( names[key] for key in order ))
 
 
 def get_character_media(character: dict, language: Language = Language.ENGLISH) -> str:
-    text = ""
-    
-    for media, _ in zip(getattr(character, 'media', []), range(8)):
-        titles = "\n".join(get_media_titles(media))
-        text += titles + "\n\n"
-
+    # Only the first 8 appearances are listed
+    text = "".join( "\n".join(get_media_titles(media)) + "\n\n" for media in islice(getattr(character, 'media', []), 8) )
     return text
 
 
 def get_main_characters(anime: dict) -> list[dict]:
-    characters = []
-    for character in getattr(anime, 'characters', []):
-        if getattr(character, 'role', '').upper() == "MAIN":
-            characters.append(character)
+    characters = [ character for character in getattr(anime, 'characters', []) if getattr(character, 'role', '').upper() == "MAIN" ]
     return characters
 